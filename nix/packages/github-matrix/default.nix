@@ -35,8 +35,13 @@ python3Packages.buildPythonApplication {
 
   propagatedBuildInputs = [
     github-action-utils
+    python3Packages.orjson
     python3Packages.result
-  ];
+  ]
+  # graphlib2 is optional; github_matrix.py falls back to the stdlib graphlib.
+  # nixpkgs does not package it at the pinned revision, so this adds nothing
+  # until it does.
+  ++ lib.optional (python3Packages ? graphlib2) python3Packages.graphlib2;
 
   makeWrapperArgs = [ "--suffix PATH : ${lib.makeBinPath [ nix-eval-jobs ]}" ];
 
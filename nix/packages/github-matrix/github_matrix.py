@@ -2,11 +2,11 @@
 
 import argparse
 from collections import Counter, defaultdict
-import graphlib
 import json
 import os
 import subprocess
 import sys
+import threading
 from typing import (
     Any,
     Dict,
@@ -21,9 +21,19 @@ from typing import (
 )
 
 from github_action_utils import debug, notice, error, set_output, warning
+import orjson
 from result import Err, Ok, Result
 
+try:
+    # Rust-backed drop-in replacement for the stdlib module
+    import graphlib2 as graphlib  # type: ignore[import-not-found]
+except ImportError:
+    import graphlib
+
 System = Literal["x86_64-linux", "aarch64-linux", "aarch64-darwin"]
+SYSTEMS: Tuple[System, ...] = get_args(System)
+# GitHub Actions matrix keys cannot contain "-"
+SYSTEMS_UNDERSCORED: Tuple[str, ...] = tuple(s.replace("-", "_") for s in SYSTEMS)
 
 
 class NixEvalJobsOutput(TypedDict):
@@ -56,6 +66,7 @@ class GitHubActionPackage(TypedDict):
     system: System
     runs_on: RunsOnConfig
     postgresql_version: NotRequired[str]
+    wave: int
 
 
 class NixEvalError(TypedDict):
@@ -114,25 +125,22 @@ def parse_nix_eval_line(
         return Ok(None)
 
     try:
-        data: NixEvalJobsOutput = json.loads(line)
+        data: NixEvalJobsOutput = orjson.loads(line)
         if "error" in data:
             error_msg = data["error"]
 
-            # Extract the core error message (last "error:" line and following context)
-            error_lines = error_msg.split("\n")
-            core_error_idx = -1
-            for i in range(len(error_lines) - 1, -1, -1):
-                if error_lines[i].strip().startswith("error:"):
-                    core_error_idx = i
+            # Extract the core error message (last "error:" line and following context).
+            # Nested errors are indented, so accept leading whitespace before "error:".
+            idx = error_msg.rfind("error:")
+            while idx >= 0:
+                line_start = error_msg.rfind("\n", 0, idx) + 1
+                if error_msg[line_start:idx].strip() == "":
                     break
+                idx = error_msg.rfind("error:", 0, idx)
 
-            if core_error_idx >= 0:
+            if idx >= 0:
                 # Take the last error line and up to 3 lines of context after it
-                error_msg = "\n".join(
-                    error_lines[
-                        core_error_idx : min(core_error_idx + 4, len(error_lines))
-                    ]
-                ).strip()
+                error_msg = "\n".join(error_msg[line_start:].split("\n", 4)[:4]).strip()
 
             return Err({"attr": data["attr"], "error": error_msg})
         if data["drvPath"] in drv_paths:
@@ -151,11 +159,11 @@ def parse_nix_eval_line(
 
 def run_nix_eval_jobs(
     cmd: List[str],
-) -> Tuple[List[NixEvalJobsOutput], List[str], List[NixEvalError]]:
+) -> Tuple[List[NixEvalJobsOutput], Counter[str], List[NixEvalError]]:
     """Run nix-eval-jobs and return parsed package data, warnings, and errors.
 
     Returns:
-        Tuple of (packages, warnings_list, errors_list)
+        Tuple of (packages, warnings_counts, errors_list)
     """
     debug(f"Running command: {' '.join(cmd)}")
 
@@ -164,28 +172,45 @@ def run_nix_eval_jobs(
     env["NO_COLOR"] = "1"
 
     process = subprocess.Popen(
-        cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, env=env
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=1,
+        text=True,
+        env=env,
+    )
+    assert process.stdout is not None and process.stderr is not None
+    stderr = process.stderr
+
+    # Drain stderr in the background so a full pipe cannot block nix-eval-jobs
+    stderr_chunks: List[str] = []
+    stderr_thread = threading.Thread(
+        target=lambda: stderr_chunks.extend(stderr), daemon=True
     )
-    stdout_data, stderr_data = process.communicate()
+    stderr_thread.start()
 
-    # Parse stdout for packages
+    # Parse stdout for packages as nix-eval-jobs emits them
     packages: List[NixEvalJobsOutput] = []
     drv_paths: Set[str] = set()
     errors_list: List[NixEvalError] = []
-    for line in stdout_data.splitlines():
+    for line in process.stdout:
         result = parse_nix_eval_line(line, drv_paths)
         if result.is_err():
             errors_list.append(result._value)
         elif result._value is not None:
             packages.append(result._value)
 
-    # Parse stderr for warnings (lines starting with "warning:")
-    warnings_list: List[str] = []
-    for line in stderr_data.splitlines():
+    process.wait()
+    stderr_thread.join()
+
+    # Parse stderr for warnings, removing the prefix for cleaner messages
+    warnings_counts: Counter[str] = Counter()
+    for line in stderr_chunks:
         line = line.strip()
-        if line.startswith("warning:") or line.startswith("evaluation warning:"):
-            # Remove "warning:" prefix for cleaner messages
-            warnings_list.append(line[8:].strip())
+        if line.startswith("evaluation warning:"):
+            warnings_counts[line[19:].lstrip()] += 1
+        elif line.startswith("warning:"):
+            warnings_counts[line[8:].lstrip()] += 1
 
     if process.returncode != 0:
         error(
@@ -193,42 +218,48 @@ def run_nix_eval_jobs(
             title="Process Failure",
         )
 
-    return packages, warnings_list, errors_list
-
-
-def is_extension_pkg(pkg: NixEvalJobsOutput) -> bool:
-    """Check if the package is a postgresql extension package."""
-    attrs = pkg["attr"].split(".")
-    return attrs[-2] == "exts"
+    return packages, warnings_counts, errors_list
 
 
 # thank you buildbot-nix https://github.com/nix-community/buildbot-nix/blob/985d069a2a45cf4a571a4346107671adc2bd2a16/buildbot_nix/buildbot_nix/build_trigger.py#L297
-def sort_pkgs_by_closures(jobs: List[NixEvalJobsOutput]) -> List[NixEvalJobsOutput]:
-    sorted_jobs = []
+def sort_pkgs_into_waves(
+    jobs: List[NixEvalJobsOutput],
+) -> Tuple[List[NixEvalJobsOutput], Dict[str, int]]:
+    """Sort jobs topologically and number their build waves.
 
+    A job's wave is one more than the highest wave among its dependencies,
+    so all jobs within a wave can be built in parallel.
+
+    Returns:
+        Tuple of (jobs in topological order, wave index by drvPath)
+    """
     # Prepare job dependencies
     job_set = {job["drvPath"] for job in jobs}
     job_closures = {
-        k["drvPath"]: set(k.get("neededSubstitutes", []))
-        .union(set(k.get("neededBuilds", [])))
-        .intersection(job_set)
-        .difference({k["drvPath"]})
+        k["drvPath"]: {
+            d
+            for d in (*k.get("neededSubstitutes", ()), *k.get("neededBuilds", ()))
+            if d in job_set and d != k["drvPath"]
+        }
         for k in jobs
     }
 
     sorter = graphlib.TopologicalSorter(job_closures)
+    sorter.prepare()
 
     job_by_drv = {job["drvPath"]: job for job in jobs}
-    for item in sorter.static_order():
-        if item in job_by_drv:
-            sorted_jobs.append(job_by_drv[item])
-
-    return sorted_jobs
-
+    sorted_jobs: List[NixEvalJobsOutput] = []
+    wave_of: Dict[str, int] = {}
+    wave = 0
+    while sorter.is_active():
+        ready = sorter.get_ready()
+        for drv in ready:
+            sorted_jobs.append(job_by_drv[drv])
+            wave_of[drv] = wave
+        sorter.done(*ready)
+        wave += 1
 
-def get_runner_for_package(pkg: NixEvalJobsOutput) -> RunsOnConfig | None:
-    """Determine the appropriate GitHub Actions runner for a package."""
-    return BUILD_RUNNER_MAP.get(pkg["system"])
+    return sorted_jobs, wave_of
 
 
 def main() -> None:
@@ -246,78 +277,77 @@ def main() -> None:
     cmd = build_nix_eval_command(max_workers, args.flake_outputs)
 
     # Run evaluation and collect packages, warnings, and errors
-    packages, warnings_list, errors_list = run_nix_eval_jobs(cmd)
-    gh_action_packages = sort_pkgs_by_closures(packages)
+    packages, warnings_counts, errors_list = run_nix_eval_jobs(cmd)
+    # Only packages missing from the cache need building, so sort just those
+    to_build = [pkg for pkg in packages if pkg.get("cacheStatus") == "notBuilt"]
+    gh_action_packages, wave_of = sort_pkgs_into_waves(to_build)
 
     def clean_package_for_output(pkg: NixEvalJobsOutput) -> GitHubActionPackage:
         """Convert nix-eval-jobs output to GitHub Actions matrix package"""
-        runner = get_runner_for_package(pkg)
-        if runner is None:
-            raise ValueError(f"No runner configuration for system: {pkg['system']}")
         returned_pkg: GitHubActionPackage = {
             "attr": pkg["attr"],
             "name": pkg["name"],
             "system": pkg["system"],
-            "runs_on": runner,
+            # BUILD_RUNNER_MAP covers every System, so a KeyError here is a bug
+            "runs_on": BUILD_RUNNER_MAP[pkg["system"]],
+            "wave": wave_of[pkg["drvPath"]],
         }
-        if is_extension_pkg(pkg):
-            # Extract PostgreSQL version from attribute path
-            attrs = pkg["attr"].split(".")
-            returned_pkg["postgresql_version"] = attrs[-3].split("_")[-1]
+        attrs = pkg["attr"].split(".")
+        if len(attrs) >= 3 and attrs[-2] == "exts":
+            # PostgreSQL extension package: extract version from attribute path
+            returned_pkg["postgresql_version"] = attrs[-3].rsplit("_", 1)[-1]
         return returned_pkg
 
-    # Group packages by system and type (checks vs packages)
-    packages_by_system: Dict[System, List[GitHubActionPackage]] = defaultdict(list)
-    checks_by_system: Dict[System, List[GitHubActionPackage]] = defaultdict(list)
+    # Group packages by system and type (checks vs packages), writing them
+    # straight into the matrix outputs
+    packages_output: Dict[str, Dict[str, List[GitHubActionPackage]]] = {
+        key: {"include": []} for key in SYSTEMS_UNDERSCORED
+    }
+    checks_output: Dict[str, Dict[str, List[GitHubActionPackage]]] = {
+        key: {"include": []} for key in SYSTEMS_UNDERSCORED
+    }
+    matrix_keys: Dict[System, str] = dict(zip(SYSTEMS, SYSTEMS_UNDERSCORED))
     for pkg in gh_action_packages:
-        if pkg.get("cacheStatus") == "notBuilt":
-            cleaned_pkg = clean_package_for_output(pkg)
-            if pkg["attr"].startswith("checks."):
-                checks_by_system[pkg["system"]].append(cleaned_pkg)
-            elif pkg["attr"].startswith("packages."):
-                packages_by_system[pkg["system"]].append(cleaned_pkg)
-
-    packages_output: Dict[str, Dict[str, List[GitHubActionPackage]]] = {}
-    for pkg_system, pkg_list in packages_by_system.items():
-        packages_output[pkg_system.replace("-", "_")] = {"include": pkg_list}
-
-    checks_output: Dict[str, Dict[str, List[GitHubActionPackage]]] = {}
-    for check_system, check_list in checks_by_system.items():
-        checks_output[check_system.replace("-", "_")] = {"include": check_list}
-
-    for system in get_args(System):
-        s = system.replace("-", "_")
-        if s not in checks_output:
-            checks_output[s] = {
-                "include": [
-                    {
-                        "attr": "",
-                        "name": "no checks to build",
-                        "system": system,
-                        "runs_on": {"labels": ["ubuntu-latest"]},
-                    }
-                ]
-            }
-        if s not in packages_output:
-            packages_output[s] = {
-                "include": [
-                    {
-                        "attr": "",
-                        "name": "no packages to build",
-                        "system": system,
-                        "runs_on": {"labels": ["ubuntu-latest"]},
-                    }
-                ]
-            }
+        attr = pkg["attr"]
+        if attr.startswith("checks."):
+            target = checks_output
+        elif attr.startswith("packages."):
+            target = packages_output
+        else:
+            continue
+        target[matrix_keys[pkg["system"]]]["include"].append(
+            clean_package_for_output(pkg)
+        )
+
+    for system, key in zip(SYSTEMS, SYSTEMS_UNDERSCORED):
+        if not checks_output[key]["include"]:
+            checks_output[key]["include"].append(
+                {
+                    "attr": "",
+                    "name": "no checks to build",
+                    "system": system,
+                    "runs_on": {"labels": ["ubuntu-latest"]},
+                    "wave": 0,
+                }
+            )
+        if not packages_output[key]["include"]:
+            packages_output[key]["include"].append(
+                {
+                    "attr": "",
+                    "name": "no packages to build",
+                    "system": system,
+                    "runs_on": {"labels": ["ubuntu-latest"]},
+                    "wave": 0,
+                }
+            )
 
     gh_output = {
         "packages": packages_output,
         "checks": checks_output,
     }
 
-    if warnings_list:
-        warning_counts = Counter(warnings_list)
-        for warn_msg, count in warning_counts.items():
+    if warnings_counts:
+        for warn_msg, count in warnings_counts.items():
             if count > 1:
                 warning(
                     f"{warn_msg} (occurred {count} times)",
@@ -344,12 +374,13 @@ def main() -> None:
     if errors_list:
         sys.exit(1)
     else:
-        formatted_msg = f"Generated GitHub Actions matrix: {json.dumps(gh_output, indent=2)}".replace(
-            "\n", "%0A"
+        # Compact JSON contains no raw newlines, so no %0A escaping is needed
+        notice(
+            f"Generated GitHub Actions matrix: {orjson.dumps(gh_output).decode()}",
+            title="GitHub Actions Matrix",
         )
-        notice(formatted_msg, title="GitHub Actions Matrix")
-        set_output("packages_matrix", json.dumps(gh_output["packages"]))
-        set_output("checks_matrix", json.dumps(gh_output["checks"]))
+        set_output("packages_matrix", orjson.dumps(gh_output["packages"]).decode())
+        set_output("checks_matrix", orjson.dumps(gh_output["checks"]).decode())
 
 
 if __name__ == "__main__":
@@ -6,9 +6,17 @@ import os
 import re
 import subprocess
 import sys
+from urllib.parse import quote
 
 CONFIG_FILE = ".package-config.json"
 
+# Handle: github.com/owner/repo, https://github.com/owner/repo,
+#         github.com/owner/repo.git
+GITHUB_URL_RE = re.compile(r"^(?:https?://)?github\.com/([^/]+)/([^/]+?)(?:\.git)?/*$")
+
+# Full commit hash, which nix expects as rev= rather than ref=
+COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
+
 
 def load_existing_config():
     """Load existing config if present, return defaults otherwise."""
@@ -32,73 +40,40 @@ def prompt(message, default=None):
 
 def parse_github_url(url):
     """Parse owner/repo from various GitHub URL formats."""
-    url = url.strip().rstrip("/")
-    # Handle: github.com/owner/repo, https://github.com/owner/repo,
-    #         github.com/owner/repo.git
-    url = re.sub(r"^https?://", "", url)
-    url = re.sub(r"\.git$", "", url)
-    match = re.match(r"^github\.com/([^/]+)/([^/]+)$", url)
+    match = GITHUB_URL_RE.match(url.strip())
     if not match:
         return None, None
     return match.group(1), match.group(2)
 
 
-def validate_github_ref(owner, repo, ref):
-    """Check that the GitHub tarball URL resolves (HTTP HEAD)."""
-    url = f"https://github.com/{owner}/{repo}/archive/{ref}.tar.gz"
-    try:
-        result = subprocess.run(
-            ["curl", "-sS", "-o", "/dev/null", "-w", "%{http_code}", "--head", url],
-            capture_output=True,
-            text=True,
-            timeout=30,
-        )
-        status = result.stdout.strip()
-        # GitHub returns 302 redirect for valid archives
-        return status in ("200", "302")
-    except (subprocess.TimeoutExpired, subprocess.CalledProcessError):
-        return False
-
-
 def prefetch_source(owner, repo, ref):
-    """Prefetch source tarball and return SRI hash."""
-    url = f"https://github.com/{owner}/{repo}/archive/{ref}.tar.gz"
-    print(f"  Prefetching source from {url} ...")
+    """Prefetch source tree and return SRI hash.
+
+    Fails if the repository or ref does not exist, so this doubles as
+    validation of the user's input.
+    """
+    # Pass the ref as a query parameter so refs containing "/" still resolve
+    if COMMIT_RE.match(ref):
+        flake_ref = f"github:{owner}/{repo}?rev={ref}"
+    else:
+        flake_ref = f"github:{owner}/{repo}?ref={quote(ref, safe='')}"
     try:
         result = subprocess.run(
-            ["nix-prefetch-url", "--unpack", "--type", "sha256", url],
+            ["nix", "flake", "prefetch", "--json", flake_ref],
             capture_output=True,
             text=True,
             timeout=300,
         )
         if result.returncode != 0:
-            print(f"  Error: nix-prefetch-url failed:\n{result.stderr}")
+            print(f"  Error: nix flake prefetch failed:\n{result.stderr}")
             return None
-        nix_hash = result.stdout.strip().split("\n")[-1]
-
-        # Convert to SRI format
-        sri_result = subprocess.run(
-            [
-                "nix",
-                "hash",
-                "convert",
-                "--to",
-                "sri",
-                "--hash-algo",
-                "sha256",
-                nix_hash,
-            ],
-            capture_output=True,
-            text=True,
-            timeout=30,
-        )
-        if sri_result.returncode != 0:
-            print(f"  Error: nix hash convert failed:\n{sri_result.stderr}")
-            return None
-        return sri_result.stdout.strip()
+        return json.loads(result.stdout)["hash"]
     except subprocess.TimeoutExpired:
         print("  Error: prefetch timed out.")
         return None
+    except (json.JSONDecodeError, KeyError):
+        print(f"  Error: unexpected nix flake prefetch output:\n{result.stdout}")
+        return None
 
 
 def compute_vendor_hash(config):
@@ -184,22 +159,16 @@ def main():
         existing.get("ref") if is_retry else None,
     )
 
-    # 2. Validate ref exists
+    # 2. Validate ref exists and prefetch source hash
     print(f"\nValidating {owner}/{repo} @ {ref} ...")
-    if not validate_github_ref(owner, repo, ref):
-        print(f"  Error: Could not resolve {owner}/{repo} at ref '{ref}'.")
-        print("  Check the URL and ref, then re-run `just package go`.")
-        sys.exit(1)
-    print("  OK\n")
-
-    # 3. Prefetch source hash
     sha256 = prefetch_source(owner, repo, ref)
     if not sha256:
-        print("  Failed to compute source hash. Re-run `just package go` to retry.")
+        print(f"  Error: Could not fetch {owner}/{repo} at ref '{ref}'.")
+        print("  Check the URL and ref, then re-run `just package go`.")
         sys.exit(1)
     print(f"  Source hash: {sha256}\n")
 
-    # 4. Compute vendorHash
+    # 3. Compute vendorHash
     config = {
         "name": name,
         "description": description,
@@ -218,7 +187,7 @@ def main():
 
     config["vendorHash"] = vendor_hash
 
-    # 5. Show summary and confirm
+    # 4. Show summary and confirm
     print("=== Summary ===")
     print(f"  Package name:  {config['name']}")
     print(f"  Description:   {config['description']}")
@@ -233,13 +202,13 @@ def main():
         print("Cancelled. Re-run `just package go` to try again.")
         sys.exit(0)
 
-    # 6. Write final config
+    # 5. Write final config
     with open(CONFIG_FILE, "w") as f:
         json.dump(config, f, indent=2)
         f.write("\n")
     print(f"\n  Wrote {CONFIG_FILE}")
 
-    # 7. Verify build
+    # 6. Verify build
     print(f"\n  Verifying: nix build .#{name} ...")
     result = subprocess.run(
         ["nix", "build", f".#{name}", "--no-link"],